@@ -25,6 +25,7 @@ import warnings
 from scipy.ndimage import median_filter
 import time
 import copy
+from functools import lru_cache
 import tensorflow as tf
 #import tensorflow.compat.v1 as tf
 from glob import glob
@@ -898,8 +899,10 @@ def predict_subtile(subtile: np.ndarray, sess: "tf.Sess") -> np.ndarray:
     return preds#, features
 
 
+@lru_cache(maxsize = None)
 def fspecial_gauss(size: int, sigma: int) -> np.ndarray:
-    """Function to mimic the 'fspecial' gaussian MATLAB function
+    """Function to mimic the 'fspecial' gaussian MATLAB function.
+       The kernel is cached per (size, sigma), and returned read-only
 
         Parameters:
          size (int): size of square guassian kernel
@@ -910,6 +913,7 @@ def fspecial_gauss(size: int, sigma: int) -> np.ndarray:
     """
     x, y = np.mgrid[-size//2 + 1:size//2 + 1, -size//2 + 1:size//2 + 1]
     g = np.exp(-((x**2 + y**2)/(2.0*sigma**2)))
+    g.flags.writeable = False
     return g
 
 
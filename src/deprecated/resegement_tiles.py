@@ -1,16 +1,20 @@
 import pandas as pd
 import numpy as np
 import os
+import multiprocessing
 import yaml
 from scipy.sparse.linalg import splu
 from skimage.transform import resize
 import hickle as hkl
 import boto3
+from botocore.errorfactory import ClientError
 from scipy.ndimage import median_filter
 import tensorflow as tf
 from glob import glob
 import rasterio
 from rasterio.transform import from_origin
+from numpy.lib.stride_tricks import sliding_window_view
+from concurrent.futures import ThreadPoolExecutor
 
 from preprocessing import slope
 from downloading.utils import calculate_and_save_best_images
@@ -20,10 +24,14 @@ from preprocessing.whittaker_smoother import Smoother
 from tof.tof_downloading import to_int16, to_float32
 from downloading.io import FileUploader,  get_folder_prefix, make_output_and_temp_folders, upload_raw_processed_s3
 from downloading.io import file_in_local_or_s3, write_tif, make_subtiles, download_folder
+from downloading.io import write_tif_to_memory
 from preprocessing.indices import evi, bi, msavi2, grndvi
 from download_and_predict_job import process_tile, make_bbox, convert_to_db
 from download_and_predict_job import fspecial_gauss, rolling_mean
 
+# Always run on CPU, except for --trt_precision which restores the GPUs
+# that the environment selected
+USER_CUDA_VISIBLE_DEVICES = os.environ.get("CUDA_VISIBLE_DEVICES")
 os.environ["CUDA_VISIBLE_DEVICES"] = "-1"
 
 
@@ -48,6 +56,15 @@ def download_raw_tile(tile_idx, local_path, subfolder = "raw"):
                        s3_folder = s3_path_to_tile)
     return None
 
+def download_raw_tiles(to_download, local_path, max_workers = 10):
+    """Downloads a list of (tile_idx, subfolder) pairs concurrently,
+       since each download is bound by S3 latency rather than CPU
+    """
+    with ThreadPoolExecutor(max_workers = max_workers) as executor:
+        list(executor.map(lambda item: download_raw_tile(item[0], local_path, item[1]),
+                          to_download))
+    return None
+
 def split_fn(item, form):
     if form == 'tile':
         overlap_left = (item.shape[2]) - (SIZE // 2) - 7
@@ -62,11 +79,8 @@ def split_fn(item, form):
 
 def cartesian(*arrays):
     mesh = np.meshgrid(*arrays)  # standard numpy meshgrid
-    dim = len(mesh)  # number of dimensions
-    elements = mesh[0].size  # number of elements, any index will do
-    flat = np.concatenate(mesh).ravel()  # flatten the whole meshgrid
-    reshape = np.reshape(flat, (dim, elements)).T  # reshape and transpose
-    return reshape
+    # stack on the last axis so each row is one combination, (elements, dim)
+    return np.stack(mesh, axis = -1).reshape(-1, len(arrays))
 
 
 def split_to_border(s2, interp, s1, dem, fname, edge):
@@ -96,19 +110,13 @@ def superresolve_tile(arr: np.ndarray, sess) -> np.ndarray:
        Returns:
             superresolved (arr): (?, X, Y, 10) array
     """
-    # Pad the input images to avoid border artifacts
-    to_resolve = np.pad(arr, ((0, 0), (4, 4), (4, 4), (0, 0)), 'reflect')
-
-    bilinear = to_resolve[..., 4:]
-    resolved = sess.run([superresolve_logits],
-                 feed_dict={superresolve_inp: to_resolve,
-                            superresolve_inp_bilinear: bilinear})[0]
-    resolved = resolved[:, 4:-4, 4:-4, :]
-    arr[..., 4:] = resolved
+    # The input is reflect-padded by 4px to avoid border artifacts, and
+    # cropped back, inside the superresolve graph
+    arr[..., 4:] = superresolve_fn(arr)
     return arr
 
 
-def superresolve_large_tile(arr: np.ndarray, sess) -> np.ndarray:
+def superresolve_large_tile(arr: np.ndarray, sess, batch_size = 4) -> np.ndarray:
     """Superresolves an input tile utilizing the open tf.sess().
        Implements a lightweight version of DSen2, a CNN-based
        image superresolution model
@@ -118,6 +126,7 @@ def superresolve_large_tile(arr: np.ndarray, sess) -> np.ndarray:
        Parameters:
             arr (arr): (?, X, Y, 10) array, where arr[..., 4:]
                        has been bilinearly upsampled
+            batch_size (int): number of windows to superresolve per call to the model
 
        Returns:
             superresolved (arr): (?, X, Y, 10) array
@@ -130,65 +139,102 @@ def superresolve_large_tile(arr: np.ndarray, sess) -> np.ndarray:
     x_end = np.copy(arr[:, x_range[-1]:, ...])
     y_end = np.copy(arr[:, :, y_range[-1]:, ...])
     print(f"There are {len(x_range)*len(y_range)} tiles to supres")
+
+    # The end x and y subtiles overlap their neighbors, so they are read
+    # from copies so that a partially resolved tile isnt served as input
+    windows = []
     for x in x_range:
         for y in y_range:
-            if x != x_range[-1] and y != y_range[-1]:
-                to_resolve = arr[:, x:x+wsize, y:y+wsize, ...]
-                arr[:, x:x+wsize, y:y+wsize, ...] = superresolve_tile(to_resolve, sess)
-            # The end x and y subtiles need to be done separately
-            # So that a partially resolved tile isnt served as input
-            elif x == x_range[-1]:
-                to_resolve = x_end[:, :, y:y+wsize, ...]
-                arr[:, x:x+wsize, y:y+wsize, ...] = superresolve_tile(to_resolve, sess)
-            elif y != y_range[-1]:
-                to_resolve = y_end[:, x:x+wsize, :, ...]
-                arr[:, x:x+wsize, y:y+wsize, ...] = superresolve_tile(to_resolve, sess)
+            if x == x_range[-1]:
+                windows.append((x, y, x_end[:, :, y:y+wsize, ...]))
+            elif y == y_range[-1]:
+                windows.append((x, y, y_end[:, x:x+wsize, :, ...]))
+            else:
+                windows.append((x, y, arr[:, x:x+wsize, y:y+wsize, ...]))
+
+    # Superresolve batch_size windows at a time, stacked along the image axis
+    n_images = arr.shape[0]
+    for i in range(0, len(windows), batch_size):
+        batch = windows[i:i + batch_size]
+        resolved = superresolve_tile(np.concatenate([window[2] for window in batch]), sess)
+        for j, (x, y, _) in enumerate(batch):
+            arr[:, x:x+wsize, y:y+wsize, ...] = resolved[j * n_images:(j + 1) * n_images]
     return arr
 
 
-def predict_subtile(subtile, sess) -> np.ndarray:
-    """ Runs temporal (convGRU + UNET) predictions on a (12, 174, 174, 13) array:
+def make_predict_input(subtile: np.ndarray) -> np.ndarray:
+    """ Prepares a (13, X, Y, 13) subtile as input for the temporal model:
         - Calculates remote sensing indices
         - Normalizes data
-        - Returns predictions for subtile
 
         Parameters:
          subtile (np.ndarray): monthly sentinel 2 + sentinel 1 mosaics
-         sess (tf.Session): tensorflow session for prediction
 
         Returns:
-         preds (np.ndarray): (160, 160) float32 [0, 1] predictions
+         subtile (np.ndarray): (13, X, Y, 17) float32 normalized input
     """
+    # Convert straight to float32, rather than dividing into float64 first
+    if subtile.dtype.kind in 'iu':
+        subtile = subtile.astype(np.float32) * np.float32(1. / 65535.)
+
+    # The indices are written directly into the float32 input tensor
+    subtile = subtile.astype(np.float32, copy = False)
+    indices = np.empty((13, subtile.shape[1], subtile.shape[2], 17), dtype = np.float32)
+    indices[:, ..., :13] = subtile
+    evi(subtile, out = indices[:, ..., 13])
+    bi(subtile, out = indices[:, ..., 14])
+    msavi2(subtile, out = indices[:, ..., 15])
+    grndvi(subtile, out = indices[:, ..., 16])
+
+    subtile = indices
+    subtile = np.clip(subtile, min_all, max_all, out = subtile)
+    subtile -= midrange
+    subtile *= inv_half_rng
+    return subtile
+
+
+def predict_subtiles(subtiles: list, sess) -> list:
+    """ Runs temporal (convGRU + UNET) predictions on a list of (13, X, Y, 13)
+        subtiles with a single call to the model
 
-    if np.sum(subtile) > 0:
-        if not isinstance(subtile.flat[0], np.floating):
-            assert np.max(subtile) > 1
-            subtile = subtile / 65535.
+        Parameters:
+         subtiles (list): monthly sentinel 2 + sentinel 1 mosaics
+         sess (tf.Session): tensorflow session for prediction
 
-        indices = np.empty((13, subtile.shape[1], subtile.shape[2], 17))
-        indices[:, ..., :13] = subtile
-        indices[:, ..., 13] = evi(subtile)
-        indices[:, ...,  14] = bi(subtile)
-        indices[:, ...,  15] = msavi2(subtile)
-        indices[:, ...,  16] = grndvi(subtile)
+        Returns:
+         preds (list): (X - 2, Y - 2) float32 [0, 1] predictions per subtile
+    """
+    preds = [np.full((SIZE, SIZE), 255) for subtile in subtiles]
+    to_predict = [i for i, subtile in enumerate(subtiles) if subtile.any()]
+
+    if len(to_predict) > 0:
+        # The batch is built in the dtype that is fed to the model
+        input_dtype = np.float16 if args.fp16_input else np.float32
+        shape = subtiles[to_predict[0]].shape
+        batch_x = np.empty((len(to_predict), 13, shape[1], shape[2], 17), dtype = input_dtype)
+        for j, i in enumerate(to_predict):
+            batch_x[j] = make_predict_input(subtiles[i])
+        lengths = np.full((batch_x.shape[0]), 12)
+        batch_preds = predict_fn(batch_x, lengths)
+        for i, preds_i in zip(to_predict, batch_preds):
+            preds[i] = preds_i.squeeze()[1:-1, 1:-1]
+    return preds
 
-        subtile = indices
-        subtile = subtile.astype(np.float32)
-        subtile = np.clip(subtile, min_all, max_all)
-        subtile = (subtile - midrange) / (rng / 2)
 
-        batch_x = subtile[np.newaxis]
-        lengths = np.full((batch_x.shape[0]), 12)
-        preds = sess.run(predict_logits,
-                              feed_dict={predict_inp:batch_x,
-                                         predict_length:lengths})
-        preds = preds.squeeze()
-        preds = preds[1:-1, 1:-1]
+def predict_subtile(subtile, sess) -> np.ndarray:
+    """ Runs temporal (convGRU + UNET) predictions on a (12, 174, 174, 13) array:
+        - Calculates remote sensing indices
+        - Normalizes data
+        - Returns predictions for subtile
 
-    else:
-        preds = np.full((SIZE, SIZE), 255)
+        Parameters:
+         subtile (np.ndarray): monthly sentinel 2 + sentinel 1 mosaics
+         sess (tf.Session): tensorflow session for prediction
 
-    return preds
+        Returns:
+         preds (np.ndarray): (160, 160) float32 [0, 1] predictions
+    """
+    return predict_subtiles([subtile], sess)[0]
 
 
 def check_if_processed(tile_idx, local_path):
@@ -276,13 +322,55 @@ def align_subtile_histograms(array) -> np.ndarray:
     return array
 
 
+def reflect_pad_inplace(arr: np.ndarray, axis: int,
+                        before: int, after: int) -> np.ndarray:
+    """ In-place equivalent of np.pad(..., 'reflect') for data that has already
+        been written to arr[before:-after] along axis
+
+        Parameters:
+         arr (np.ndarray): array to pad, modified in place
+         axis (int): axis to pad along
+         before (int): number of elements to reflect at the start of axis
+         after (int): number of elements to reflect at the end of axis
+
+        Returns:
+         arr (np.ndarray): the padded array
+    """
+    view = np.moveaxis(arr, axis, 0)
+    end = view.shape[0] - after
+    if before > 0:
+        view[:before] = view[2 * before:before:-1]
+    if after > 0:
+        view[end:] = view[end - 2:end - 2 - after:-1]
+    return arr
+
+
+def temporal_median(arr: np.ndarray) -> np.ndarray:
+    """ Equivalent to np.median(arr, axis = 0), with a single partial sort.
+        For an even number of dates, the lower middle value is the max of the
+        lower partition rather than a second partition pass
+
+        Parameters:
+         arr (np.ndarray): (n, ...) array, with no NaN values
+
+        Returns:
+         median (np.ndarray): (...) median over the first axis
+    """
+    mid = arr.shape[0] // 2
+    part = np.partition(arr, mid, axis = 0)
+    if arr.shape[0] % 2 == 1:
+        return part[mid]
+    return (np.max(part[:mid], axis = 0) + part[mid]) / 2
+
+
 def process_subtiles(x: int, y: int, s2: np.ndarray = None,
                        dates: np.ndarray = None,
                        interp: np.ndarray = None, s1 = None, dem = None,
                        sess = None,
                        gap_sess = None, tiles_folder = None, tiles_array = None,
                        right_all = None,
-                       left_all = None) -> None:
+                       left_all = None,
+                       batch_size = 4) -> None:
     '''Wrapper function to interpolate clouds and temporal gaps, superresolve tiles,
        calculate relevant indices, and save predicted tree cover as a .npy
 
@@ -295,14 +383,13 @@ def process_subtiles(x: int, y: int, s2: np.ndarray = None,
         s1 (arr): (12, 160, 160, 2) float32 array of dB sentinel 1 data
         sess (tf.Session): tensorflow sesion to use for temporal predictions
         gap_sess (tf.Session): tensorflow session to use for median predicitons
+        batch_size (int): number of subtiles to predict per call to the model
 
        Returns:
         None
     '''
     x = str(int(x))
     y = str(int(y))
-    x = x[:-2] if ".0" in x else x
-    y = y[:-2] if ".0" in y else y
 
     s2 = interpolation.interpolate_na_vals(s2)
     s2 = np.float32(s2)
@@ -318,6 +405,9 @@ def process_subtiles(x: int, y: int, s2: np.ndarray = None,
     #sm = Smoother(lmbd = 150, size = 36, nbands = 10, dim = SIZE + 14)
     n_median = 0
     median_thresh = 5
+    batch = []
+    # One float32 input buffer per batch slot, reused across subtiles
+    subtile_bufs = np.empty((batch_size, 13, SIZE + 14, SIZE + 14, 13), dtype = np.float32)
     # Iterate over each subitle and prepare it for processing and generate predictions
     for t in range(len(tiles_folder)):
     #while t < len(tiles_folder):
@@ -331,11 +421,10 @@ def process_subtiles(x: int, y: int, s2: np.ndarray = None,
         end_y = start_y + tile_array[3]
         subset = s2[:, start_y:end_y, start_x:end_x, :]
         interp_tile = interp[:, start_y:end_y, start_x:end_x]
-        interp_tile_sum = np.sum(interp_tile, axis = (1, 2))
-        dates_tile = np.copy(dates)
+        dates_tile = dates
         dem_subtile = dem[np.newaxis, start_y:end_y, start_x:end_x]
 
-        min_clear_images_per_date = np.sum(interp_tile == 0, axis = (0))
+        min_clear_images_per_date = np.count_nonzero(interp_tile == 0, axis = 0)
         print(f"There are only {np.min(min_clear_images_per_date)} clear images")
         no_images = False
         if np.percentile(min_clear_images_per_date, 10) < 2 or np.percentile(min_clear_images_per_date, 5) < 1:
@@ -350,18 +439,18 @@ def process_subtiles(x: int, y: int, s2: np.ndarray = None,
         #    dates_tile = np.delete(dates_tile, to_remove)
         #    subset = np.delete(subset, to_remove, 0)
         #    interp_tile = np.delete(interp_tile, to_remove, 0)
-        print(np.sum(np.isnan(subset), axis = (1, 2, 3)))
-        to_remove = np.argwhere(np.sum(np.isnan(subset), axis = (1, 2, 3)) > 0).flatten()
-        if len(to_remove) > 0:
-            print(f"Removing {to_remove} NA dates")
-            dates_tile = np.delete(dates_tile, to_remove)
-            subset = np.delete(subset, to_remove, 0)
-            interp_tile = np.delete(interp_tile, to_remove, 0)
+        n_na_per_date = np.count_nonzero(np.isnan(subset), axis = (1, 2, 3))
+        print(n_na_per_date)
+        keep = n_na_per_date == 0
+        if not np.all(keep):
+            print(f"Removing {np.argwhere(~keep).flatten()} NA dates")
+            dates_tile = dates_tile[keep]
+            subset = subset[keep]
+            interp_tile = interp_tile[keep]
 
         # Transition (n, 160, 160, ...) array to (72, 160, 160, ...)
         subtile = subset
-        subtile_copy = np.copy(subset)
-        subtile_median = np.median(subtile_copy, axis = 0)
+        subtile_median = temporal_median(subset)
         subtile_median = subtile_median[np.newaxis]
 
         # This step reduces the noise because the whittaker smoother doesn't
@@ -372,22 +461,15 @@ def process_subtiles(x: int, y: int, s2: np.ndarray = None,
         output = f"{path}/right{str(folder_y)}/{str(folder_x)}.npy"
         s1_subtile = s1[:, start_y:end_y, start_x:end_x,  :]
 
-        # Pad the corner / edge subtiles within each tile
+        # Pad the corner / edge subtiles within each tile. The unpadded data is
+        # written into a reusable float32 buffer and reflected in place
+        pad_u, pad_d, pad_l, pad_r = 0, 0, 0, 0
         if subtile.shape[2] == SIZE + 7:
             pad_u = 7 if start_y != 0 else 0
             pad_d = 7 if start_y == 0 else 0
-            subtile = np.pad(subtile, ((0, 0,), (0, 0), (pad_u, pad_d), (0, 0)), 'reflect')
-            s1_subtile = np.pad(s1_subtile, ((0, 0,), (0, 0), (pad_u, pad_d), (0, 0)), 'reflect')
-            dem_subtile = np.pad(dem_subtile, ((0, 0,), (0, 0), (pad_u, pad_d)), 'reflect')
-            subtile_median = np.pad(subtile_median, ((0, 0,), (0, 0), (pad_u, pad_d), (0, 0)), 'reflect')
-
         if subtile.shape[1] == SIZE + 7:
             pad_l = 7 if start_y == 0 else 0
             pad_r = 7 if start_y != 0 else 0
-            subtile = np.pad(subtile, ((0, 0,), (pad_l, pad_r), (0, 0), (0, 0)), 'reflect')
-            s1_subtile = np.pad(s1_subtile, ((0, 0,), (pad_l, pad_r), (0, 0), (0, 0)), 'reflect')
-            dem_subtile = np.pad(dem_subtile, ((0, 0,), (pad_l, pad_r), (0, 0)), 'reflect')
-            subtile_median = np.pad(subtile_median, ((0, 0,), (pad_l, pad_r), (0, 0), (0, 0)), 'reflect')
 
         # Interpolate (whittaker smooth) the array and superresolve 20m to 10m
         #subtile = sm.interpolate_array(subtile)
@@ -396,12 +478,15 @@ def process_subtiles(x: int, y: int, s2: np.ndarray = None,
         subtile_s2 = subtile#superresolve_tile(subtile, sess = superresolve_sess)
 
         # Concatenate the DEM and Sentinel 1 data
-        subtile = np.empty((13, SIZE + 14, SIZE + 14, 13))
-        subtile[:-1, ..., :10] = subtile_s2
-        subtile[:, ..., 10] = dem_subtile.repeat(13, axis = 0)
-        subtile[:-1, ..., 11:] = s1_subtile
-        subtile[-1, ..., :10] = subtile_median
-        subtile[-1, ..., 11:] = np.median(s1_subtile, axis = (0))
+        subtile = subtile_bufs[len(batch)]
+        inner = subtile[:, pad_l:SIZE + 14 - pad_r, pad_u:SIZE + 14 - pad_d]
+        inner[:-1, ..., :10] = subtile_s2
+        inner[:, ..., 10] = dem_subtile
+        inner[:-1, ..., 11:] = s1_subtile
+        inner[-1, ..., :10] = subtile_median
+        inner[-1, ..., 11:] = temporal_median(s1_subtile)
+        reflect_pad_inplace(subtile, 2, pad_u, pad_d)
+        reflect_pad_inplace(subtile, 1, pad_l, pad_r)
 
         # Create the output folders for the subtile predictions
         output_folder = "/".join(output.split("/")[:-1])
@@ -415,7 +500,7 @@ def process_subtiles(x: int, y: int, s2: np.ndarray = None,
 
         subtile = align_subtile_histograms(subtile)
         #np.save('subtile.npy', subtile)
-        subtile = np.clip(subtile, 0, 1)
+        subtile = np.clip(subtile, 0, 1, out = subtile)
         assert subtile.shape[1] >= 145, f"subtile shape is {subtile.shape}"
         assert subtile.shape[0] == 13, f"subtile shape is {subtile.shape}"
 
@@ -426,26 +511,37 @@ def process_subtiles(x: int, y: int, s2: np.ndarray = None,
         if no_images:
             print(f"{str(folder_y)}/{str(folder_x)}: {len(dates_tile)} / {len(dates)} dates -- no data")
             preds = np.full((SIZE, SIZE), 255)
+            save_subtile_preds(preds, output, output2, left_all, right_all)
         else:
             print(f"{str(folder_y)}/{str(folder_x)}: {len(dates_tile)} / {len(dates)} dates,"
                 f"for: {dates_tile}")
-            preds = predict_subtile(subtile, sess)
-
-
-        left_mean = np.mean(preds[:,  (SIZE - 8) // 2 : (SIZE) // 2])
-        right_mean = np.mean(preds[:, (SIZE) // 2 : (SIZE + 8) // 2])
-        min_ref_median = np.minimum(left_all, right_all)
-        max_ref_median = np.maximum(left_all, right_all)
-        source_median = 100 * np.median(preds)
-        print(f"The predict median is {np.median(preds)}")
-        if abs(left_mean - right_mean) < 0.3 and np.logical_and(
-            source_median <= max_ref_median + 25, source_median >= min_ref_median - 25):
-            np.save(output, preds)
-            np.save(output2, preds)
-            #np.save("subtile.npy", subtile)
-        else:
-            print(f"Skipping because {abs(left_mean - right_mean)} difference or "
-                f"{source_median} median compared to {min_ref_median}-{max_ref_median}")
+            batch.append((subtile, output, output2))
+
+        # Predict the subtiles in batches, rather than one at a time
+        if len(batch) == batch_size or (t == len(tiles_folder) - 1 and len(batch) > 0):
+            batch_preds = predict_subtiles([item[0] for item in batch], sess)
+            for preds, (_, output_i, output2_i) in zip(batch_preds, batch):
+                save_subtile_preds(preds, output_i, output2_i, left_all, right_all)
+            batch = []
+
+
+def save_subtile_preds(preds, output, output2, left_all, right_all) -> None:
+    """Saves the subtile predictions to the tile and neighbor folders,
+       if they are consistent with the existing predictions on either side
+    """
+    left_mean = np.mean(preds[:,  (SIZE - 8) // 2 : (SIZE) // 2])
+    right_mean = np.mean(preds[:, (SIZE) // 2 : (SIZE + 8) // 2])
+    min_ref_median = np.minimum(left_all, right_all)
+    max_ref_median = np.maximum(left_all, right_all)
+    source_median = 100 * np.median(preds)
+    print(f"The predict median is {np.median(preds)}")
+    if abs(left_mean - right_mean) < 0.3 and np.logical_and(
+        source_median <= max_ref_median + 25, source_median >= min_ref_median - 25):
+        np.save(output, preds)
+        np.save(output2, preds)
+    else:
+        print(f"Skipping because {abs(left_mean - right_mean)} difference or "
+            f"{source_median} median compared to {min_ref_median}-{max_ref_median}")
 
 
 def preprocess_tile(arr, dates, interp):
@@ -514,8 +610,7 @@ def resegment_border(tile_x, tile_y, edge, local_path):
 
     if processed and processed_neighbor:
         print(f"Downloading {tile_x}, {tile_y}")
-        download_raw_tile((tile_x, tile_y), local_path, "tiles")
-        download_raw_tile(neighbor_id, local_path, "tiles")
+        download_raw_tiles([((tile_x, tile_y), "tiles"), (neighbor_id, "tiles")], local_path)
         tile_tif, _ = load_tif((tile_x, tile_y), local_path)
         if type(tile_tif) is not np.ndarray:
             print("Skipping because one of the TIFS doesnt exist")
@@ -546,18 +641,19 @@ def resegment_border(tile_x, tile_y, edge, local_path):
 
         if left_right_diff > 9 or other_metrics or np.isnan(left_right_diff):
 
-            download_raw_tile((tile_x, tile_y), local_path, "processed")
+            to_download = [((tile_x, tile_y), "processed"), ((tile_x, tile_y), "raw")]
+            if edge == "right":
+                print(f"Downloading {neighbor_id}")
+                to_download += [(neighbor_id, "raw"), (neighbor_id, "processed")]
+            download_raw_tiles(to_download, local_path)
+
             test_subtile = np.load(f"{local_path}/{tile_x}/{tile_y}/processed/0/0.npy")
             print(test_subtile.shape)
             #if test_subtile.shape[0] != SIZE:
             #    print("Skipping cause of subtile size")
             #    return 0, None, None
-            download_raw_tile((tile_x, tile_y), local_path, "raw")
 
             if edge == "right":
-                print(f"Downloading {neighbor_id}")
-                download_raw_tile(neighbor_id, local_path, "raw")
-                download_raw_tile(neighbor_id, local_path, "processed")
                 test_subtile = np.load(f"{local_path}/{neighbor_id[0]}/{neighbor_id[1]}/processed/0/0.npy")
                 print(test_subtile.shape)
                 #if test_subtile.shape[0] != SIZE:
@@ -652,7 +748,7 @@ def resegment_border(tile_x, tile_y, edge, local_path):
         tiles_folder_y = np.hstack([np.arange(0, s1.shape[1] - SIZE, gap_y), np.array(s1.shape[1] - SIZE)])
 
         tiles_array, tiles_folder = make_tiles_right_neighb(tiles_folder_x, tiles_folder_y)
-        process_subtiles(x, y, s2, dates, interp, s1, dem, predict_sess, gap_sess, tiles_folder, tiles_array,
+        process_subtiles(tile_x, tile_y, s2, dates, interp, s1, dem, predict_sess, gap_sess, tiles_folder, tiles_array,
             right_all, left_all)
 
     return 1, s2_shape, s2_neighb_shape, left_right_diff
@@ -671,26 +767,27 @@ def recreate_resegmented_tifs(out_folder: str, shape) -> np.ndarray:
          predictions (np.ndarray): 6 x 6 km tree cover data as a uint8 from 0-100 w/ 255 no-data flag
     """
     print(f"Recreating: {out_folder}")
-    n_up = len(glob(out_folder + "*/up*.npy"))
-    n_down = len(glob(out_folder + "*/down*.npy"))
-    n_left = len(glob(out_folder + "*/left*.npy"))
-    n_right = len(glob(out_folder + "right*/*.npy"))
-
-    right = [x for x in os.listdir(out_folder) if 'right' in x]
-
-    x_tiles = [x for x in os.listdir(out_folder) if 'right' not in x]
-    x_tiles = [x for x in x_tiles if '.DS' not in x]
-    x_tiles = [x for x in x_tiles if len(os.listdir(out_folder + "/" + x)) > 0]
-    x_tiles = [int(x) for x in x_tiles]
-
-    max_x = np.max(x_tiles) + SIZE
-    for x_tile in x_tiles:
-        y_tiles = [y for y in os.listdir(out_folder + str(x_tile) + "/") if '.DS' not in y]
-        y_tiles = [y for y in y_tiles if 'left' not in y]
-        y_tiles = [y for y in y_tiles if 'down' not in y]
-        y_tiles = [int(y[:-4]) for y in y_tiles if 'up' not in y]
-
-    n_tiles = len(glob(out_folder + "*/*.npy"))
+    # Scan out_folder and each of its subfolders once, and reuse the listings
+    # for the subtile counts and every mosaic block below
+    folder_files = {}
+    with os.scandir(out_folder) as folders:
+        for folder in folders:
+            if folder.is_dir() and '.DS' not in folder.name:
+                with os.scandir(folder.path) as files:
+                    folder_files[folder.name] = [f.name for f in files if '.DS' not in f.name]
+
+    right = [x for x in folder_files if 'right' in x]
+    x_tiles = [int(x) for x in folder_files if 'right' not in x and len(folder_files[x]) > 0]
+
+    n_tiles, n_up, n_down, n_left, n_right = 0, 0, 0, 0, 0
+    for folder, files in folder_files.items():
+        for file in files:
+            if file.endswith(".npy"):
+                n_tiles += 1
+                n_up += file.startswith("up")
+                n_down += file.startswith("down")
+                n_left += file.startswith("left")
+                n_right += folder.startswith("right")
     n_border = n_up + n_down + n_left + n_right
     predictions = np.full((shape[1], shape[0], n_tiles), np.nan, dtype = np.float32)
     mults = np.full((shape[1], shape[0], n_tiles), 0, dtype = np.float32)
@@ -698,13 +795,13 @@ def recreate_resegmented_tifs(out_folder: str, shape) -> np.ndarray:
     i = 0
 
     for x_tile in x_tiles:
-        y_tiles = [y for y in os.listdir(out_folder + str(x_tile) + "/") if '.DS' not in y]
-        y_tiles = [y for y in y_tiles if 'left' not in y]
+        files = folder_files[str(x_tile)]
+        y_tiles = [y for y in files if 'left' not in y]
         y_tiles = [y for y in y_tiles if 'down' not in y]
         y_tiles = [int(y[:-4]) for y in y_tiles if 'up' not in y]
         for y_tile in y_tiles:
             output_file = out_folder + str(x_tile) + "/" + str(y_tile) + ".npy"
-            if os.path.exists(output_file):
+            if str(y_tile) + ".npy" in files:
                 prediction = np.load(output_file)
                 subtile_size = prediction.shape[0]
                 if np.sum(prediction) < subtile_size*subtile_size*255:
@@ -728,11 +825,11 @@ def recreate_resegmented_tifs(out_folder: str, shape) -> np.ndarray:
     # LEFT BLOCK
     if n_left > 0:
         for x_tile in x_tiles:
-            y_tiles = [y for y in os.listdir(out_folder + str(x_tile) + "/") if '.DS' not in y]
-            y_tiles = [int(y[4:-4]) for y in y_tiles if 'left' in y]
+            files = folder_files[str(x_tile)]
+            y_tiles = [int(y[4:-4]) for y in files if 'left' in y]
             for y_tile in y_tiles:
                 output_file = out_folder + str(x_tile) + "/left" + str(y_tile) + ".npy"
-                if os.path.exists(output_file):
+                if "left" + str(y_tile) + ".npy" in files:
                     prediction = np.load(output_file)
                     subtile_size = prediction.shape[0]
                     if subtile_size == 208:
@@ -755,10 +852,11 @@ def recreate_resegmented_tifs(out_folder: str, shape) -> np.ndarray:
         for x_tile in right:
             x_tile_name = x_tile
             x_tile = int(x_tile[5:])
-            y_tiles = [int(y[:-4]) for y in os.listdir(out_folder + str(x_tile_name) + "/") if '.DS' not in y]
+            files = folder_files[x_tile_name]
+            y_tiles = [int(y[:-4]) for y in files]
             for y_tile in y_tiles:
                 output_file = out_folder + str(x_tile_name) + "/" + str(y_tile) + ".npy"
-                if os.path.exists(output_file):
+                if str(y_tile) + ".npy" in files:
                     prediction = np.load(output_file)
                     subtile_size = prediction.shape[0]
                     if subtile_size == 208:
@@ -778,11 +876,11 @@ def recreate_resegmented_tifs(out_folder: str, shape) -> np.ndarray:
 
     if n_up > 0:
         for x_tile in x_tiles:
-            y_tiles = [y for y in os.listdir(out_folder + str(x_tile) + "/") if '.DS' not in y]
-            y_tiles = [int(y[2:-4]) for y in y_tiles if 'up' in y]
+            files = folder_files[str(x_tile)]
+            y_tiles = [int(y[2:-4]) for y in files if 'up' in y]
             for y_tile in y_tiles:
                 output_file = out_folder + str(x_tile) + "/up" + str(y_tile) + ".npy"
-                if os.path.exists(output_file):
+                if "up" + str(y_tile) + ".npy" in files:
                     prediction = np.load(output_file)
                     subtile_size = prediction.shape[0]
                     if subtile_size == 208:
@@ -802,11 +900,11 @@ def recreate_resegmented_tifs(out_folder: str, shape) -> np.ndarray:
 
     if n_down > 0:
         for x_tile in x_tiles:
-            y_tiles = [y for y in os.listdir(out_folder + str(x_tile) + "/") if '.DS' not in y]
-            y_tiles = [int(y[4:-4]) for y in y_tiles if 'down' in y]
+            files = folder_files[str(x_tile)]
+            y_tiles = [int(y[4:-4]) for y in files if 'down' in y]
             for y_tile in y_tiles:
                 output_file = out_folder + str(x_tile) + "/down" + str(y_tile) + ".npy"
-                if os.path.exists(output_file):
+                if "down" + str(y_tile) + ".npy" in files:
                     prediction = np.load(output_file)
                     subtile_size = prediction.shape[0]
                     if subtile_size == 208:
@@ -864,67 +962,502 @@ def recreate_resegmented_tifs(out_folder: str, shape) -> np.ndarray:
     predictions[np.isnan(predictions)] = 255.
     predictions = predictions.astype(np.uint8)
 
+    # Evaluate every 3x3 window at once, (H - 3, W - 3, 3, 3), rather than
+    # looping over each pixel. The window rules are evaluated against the
+    # unfiltered predictions and then applied to original_preds
     original_preds = np.copy(predictions)
-    for x_i in range(0, predictions.shape[0] - 3):
-        for y_i in range(0, predictions.shape[1] - 3):
-            window = original_preds[x_i:x_i+3, y_i:y_i+3]
-            if np.max(window) < 35:
-                sum_under_35 = np.sum(np.logical_and(window > 10, window < 35))
-                if np.logical_and(sum_under_35 > 6, sum_under_35 < 10):
-                    window = 0.
-
-            # This removes or mitigates some of the "noisiness" of individual trees
-            # Which could have odd shapes depending on where they sit within or between
-            # Sentinel pixels
-            if np.max(window) >= 25 and np.argmax(window) == 4:
-                window_binary = window >= 25
-                if np.sum(window_binary) < 4:
-                    if np.sum(window_binary[1]) < 3 and np.sum(window_binary[:, 1]) < 3:
-                        window[0, :] = 0
-                        window[2, :] = 0
-                        window[:, 0] = 0
-                        window[:, 2] = 0
-
-    predictions = original_preds
-    predictions[predictions <= .20*100] = 0.
-    predictions[predictions > 100] = 255.
+    windows = sliding_window_view(predictions, (3, 3))[:-1, :-1]
+    window_max = np.max(windows, axis = (-1, -2))
+    window_argmax = np.argmax(np.reshape(windows, windows.shape[:2] + (9,)), axis = -1)
+    window_binary = windows >= 25
+
+    sum_under_35 = np.sum(np.logical_and(windows > 10, windows < 35), axis = (-1, -2))
+    is_low = (window_max < 35) * (sum_under_35 > 6) * (sum_under_35 < 10)
+
+    # This removes or mitigates some of the "noisiness" of individual trees
+    # Which could have odd shapes depending on where they sit within or between
+    # Sentinel pixels
+    is_single_tree = (window_max >= 25) * (window_argmax == 4) * ~is_low
+    is_single_tree *= np.sum(window_binary, axis = (-1, -2)) < 4
+    is_single_tree *= np.sum(window_binary[..., 1, :], axis = -1) < 3
+    is_single_tree *= np.sum(window_binary[..., :, 1], axis = -1) < 3
+
+    # Low, uniform windows are zeroed entirely, and single trees keep only
+    # their center pixel. Both are applied in one pass over the 3x3 offsets
+    n_x, n_y = is_single_tree.shape
+    for x_off in range(3):
+        for y_off in range(3):
+            to_zero = is_low if x_off == 1 and y_off == 1 else is_low + is_single_tree
+            original_preds[x_off:x_off + n_x, y_off:y_off + n_y][to_zero] = 0
+
+    # Threshold low predictions to 0 and flag > 100 as no-data in a single
+    # pass, with a lookup table over the uint8 values
+    lookup = np.arange(256, dtype = np.uint8)
+    lookup[:21] = 0
+    lookup[101:] = 255
+    predictions = lookup[original_preds]
 
     return predictions, mults
 
 
-def cleanup(path_to_tile, path_to_right, delete = True, upload = True):
+def scan_subfolders(path: str) -> list:
+    """ Lists every file one folder below path, with one os.scandir per folder
+
+        Parameters:
+         path (str): folder to scan, e.g. path_to_tile + "processed/"
 
-    for file in glob(path_to_right + "processed/*/left*"):
-        internal_folder = file[len(path_to_tile):]
-        print(internal_folder)
-        key = f'2020/processed/{str(int(x) + 1)}/{str(y)}/{internal_folder}'
-        if upload:
-            uploader.upload(bucket = 'tof-output', key = key, file = file)
+        Returns:
+         files (list): (subfolder name, os.DirEntry) of each file
+    """
+    files = []
+    if not os.path.isdir(path):
+        return files
+    with os.scandir(path) as folders:
+        for folder in folders:
+            if folder.is_dir():
+                with os.scandir(folder.path) as entries:
+                    files.extend((folder.name, entry) for entry in entries if entry.is_file())
+    return files
+
+
+def cleanup(path_to_tile, path_to_right, x, y, delete = True, upload = True,
+            max_workers = 16):
+
+    # Scan each processed / raw folder once, and sort the files into uploads
+    # (left predictions in the neighbor, right predictions in the tile) and deletes
+    tile_processed = scan_subfolders(path_to_tile + "processed/")
+    tile_raw = scan_subfolders(path_to_tile + "raw/")
+
+    # Collect every (key, file) to upload, and then upload them concurrently
+    to_upload = []
+    for folder, entry in scan_subfolders(path_to_right + "processed/"):
+        if entry.name.startswith("left"):
+            internal_folder = entry.path[len(path_to_tile):]
+            print(internal_folder)
+            key = f'2020/processed/{str(int(x) + 1)}/{str(y)}/{internal_folder}'
+            to_upload.append((key, entry.path))
+
+    for folder, entry in tile_processed:
+        if folder.startswith("right") and entry.name.endswith(".npy"):
+            internal_folder = entry.path[len(path_to_tile):]
+            print(internal_folder)
+            key = f'2020/processed/{x}/{y}/' + internal_folder
+            to_upload.append((key, entry.path))
+
+    # The files are only deleted once every upload has finished
+    if upload:
+        with ThreadPoolExecutor(max_workers = max_workers) as executor:
+            list(executor.map(lambda item: uploader.upload(bucket = 'tof-output',
+                                                           key = item[0], file = item[1],
+                                                           progress = False),
+                              to_upload))
+
+    if delete:
+        for _, entry in tile_processed + tile_raw:
+            os.remove(entry.path)
 
-    for file in glob(path_to_tile + "processed/right*/*.npy"):
-        internal_folder = file[len(path_to_tile):]
-        print(internal_folder)
-        key = f'2020/processed/{x}/{y}/' + internal_folder
-        if upload:
-            uploader.upload(bucket = 'tof-output', key = key, file = file)
-            #if delete:
-            #    os.remove(_file)
+    return None
 
-    for folder in glob(path_to_tile + "processed/*"):
-        for file in os.listdir(folder):
-            if delete:
-                os.remove(folder + "/" + file)
 
-    for folder in glob(path_to_tile + "raw/*"):
-        for file in os.listdir(folder):
-            if delete:
-                os.remove(folder + "/" + file)
+def convert_to_trt(graph_def, output_nodes: list):
+    """ Converts a frozen GraphDef with TF-TRT, so that the supported subgraphs
+        run as TensorRT engines at args.trt_precision (e.g. FP16). This needs
+        a visible GPU, which __main__ re-enables when --trt_precision is set
 
-    for file in os.listdir(folder):
-        if delete:
-            os.remove(folder + "/" + file)
+        Parameters:
+         graph_def (tf.compat.v1.GraphDef): frozen graph to convert
+         output_nodes (list): names of the output nodes, which are kept in TF
+
+        Returns:
+         graph_def (tf.compat.v1.GraphDef): converted frozen graph
+    """
+    import inspect
+    from tensorflow.python.compiler.tensorrt import trt_convert as trt
+    print(f"Converting graph to TensorRT {args.trt_precision}")
+    # The denylist kwarg was called nodes_blacklist before TF 2.4
+    parameters = inspect.signature(trt.TrtGraphConverter.__init__).parameters
+    denylist = 'nodes_denylist' if 'nodes_denylist' in parameters else 'nodes_blacklist'
+    # The GraphDef converter raises in eager mode, so it is run in its own graph
+    with tf.Graph().as_default():
+        converter = trt.TrtGraphConverter(input_graph_def = graph_def,
+                                          precision_mode = args.trt_precision,
+                                          max_workspace_size_bytes = 1 << 30,
+                                          is_dynamic_op = True,
+                                          **{denylist: output_nodes})
+        return converter.convert()
+
+
+def make_session_config():
+    """ Makes the tf.Session config: the CPU threads are split between the
+        worker processes so that they don't oversubscribe the cores, GPU
+        memory is allocated as needed, and XLA JIT compilation is enabled
+
+        Returns:
+         config (tf.compat.v1.ConfigProto): session config
+    """
+    n_threads = max(1, multiprocessing.cpu_count() // int(args.n_processes))
+    config = tf.compat.v1.ConfigProto(intra_op_parallelism_threads = n_threads,
+                                      inter_op_parallelism_threads = 2)
+    config.gpu_options.allow_growth = True
+    config.graph_options.optimizer_options.global_jit_level = tf.compat.v1.OptimizerOptions.ON_2
+    return config
+
+
+def wrap_superresolve_graph(graph_def):
+    """ Wraps the frozen superresolve graph, with the same in-graph reflect
+        padding and cropping as the tf.Session version, as a ConcreteFunction
+
+        Parameters:
+         graph_def (tf.compat.v1.GraphDef): frozen superresolve graph
+
+        Returns:
+         superresolve_fn (function): (N, X, Y, 10) np.ndarray -> (N, X, Y, 4)
+    """
+    def _imports(inp):
+        padded = tf.pad(inp, [[0, 0], [4, 4], [4, 4], [0, 0]], mode = 'REFLECT')
+        logits = tf.compat.v1.import_graph_def(graph_def,
+            input_map = {'Placeholder:0': padded, 'Placeholder_1:0': padded[..., 4:]},
+            return_elements = ['Add_2:0'], name = 'superresolve')[0]
+        return logits[:, 4:-4, 4:-4, :]
+
+    wrapped = tf.compat.v1.wrap_function(_imports,
+        [tf.TensorSpec([None, None, None, 10], tf.float32)])
+
+    def superresolve_fn(arr):
+        return wrapped(tf.constant(arr, dtype = tf.float32)).numpy()
+    return superresolve_fn
+
+
+def wrap_predict_graph(graph_def):
+    """ Wraps the frozen temporal prediction graph, including the optional
+        float16 input cast, as a ConcreteFunction
+
+        Parameters:
+         graph_def (tf.compat.v1.GraphDef): frozen prediction graph
+
+        Returns:
+         predict_fn (function): (batch_x, lengths) np.ndarrays -> predictions
+    """
+    input_dtype = tf.float16 if args.fp16_input else tf.float32
+    length_node = [node for node in graph_def.node if node.name == 'PlaceholderWithDefault'][0]
+    length_dtype = tf.as_dtype(length_node.attr['dtype'].type)
+
+    def _imports(inp, length):
+        return tf.compat.v1.import_graph_def(graph_def,
+            input_map = {'Placeholder:0': tf.cast(inp, tf.float32),
+                         'PlaceholderWithDefault:0': length},
+            return_elements = ['conv2d_13/Sigmoid:0'], name = 'predict')[0]
+
+    wrapped = tf.compat.v1.wrap_function(_imports,
+        [tf.TensorSpec([None, None, None, None, 17], input_dtype),
+         tf.TensorSpec([None], length_dtype)])
+
+    def predict_fn(batch_x, lengths):
+        return wrapped(tf.constant(batch_x, dtype = input_dtype),
+                       tf.constant(lengths, dtype = length_dtype)).numpy()
+    return predict_fn
+
+
+def load_models() -> None:
+    """ Loads the frozen superresolve and temporal prediction graphs into
+        tf.Sessions, and sets them (and their compiled callables) as globals
+        of this process
+    """
+    global superresolve_sess, superresolve_fn, predict_sess, predict_fn
+
+    # Optionally run ONNX exports of the frozen graphs (e.g. from tf2onnx) with
+    # onnxruntime, which applies its full set of graph optimizations
+    if args.onnx_model_path is not None:
+        import onnxruntime as ort
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        providers = ["CUDAExecutionProvider", "CPUExecutionProvider"]
+        print(f"Loading ONNX models from {args.onnx_model_path}")
+        superresolve_sess = ort.InferenceSession(args.onnx_model_path + "superresolve.onnx",
+                                                 options, providers = providers)
+        predict_sess = ort.InferenceSession(args.onnx_model_path + "predict.onnx",
+                                            options, providers = providers)
+
+        # The exported superresolve graph takes the padded input, as the .pb does
+        def superresolve_fn(arr):
+            padded = np.pad(arr, ((0, 0), (4, 4), (4, 4), (0, 0)), 'reflect').astype(np.float32)
+            resolved = superresolve_sess.run(None, {"Placeholder:0": padded,
+                                                    "Placeholder_1:0": padded[..., 4:]})[0]
+            return resolved[:, 4:-4, 4:-4, :]
+
+        # onnxruntime doesn't cast inputs the way a tf.Session feed does, so the
+        # lengths are cast to the type the exported graph declares, e.g. tensor(int32)
+        length_type = [inp.type for inp in predict_sess.get_inputs()
+                       if inp.name == "PlaceholderWithDefault:0"][0]
+        length_dtype = {"tensor(int32)": np.int32, "tensor(int64)": np.int64}[length_type]
+
+        def predict_fn(batch_x, lengths):
+            return predict_sess.run(None, {"Placeholder:0": batch_x.astype(np.float32, copy = False),
+                                           "PlaceholderWithDefault:0": lengths.astype(length_dtype)})[0]
+        return None
+
+    superresolve_graph_def = tf.compat.v1.GraphDef()
+    predict_graph_def = tf.compat.v1.GraphDef()
+    config = make_session_config()
+
+    # With eager execution (TF2) the frozen graphs are wrapped as ConcreteFunctions,
+    # which are called directly rather than through a tf.Session, and the session
+    # config is applied to the eager context instead
+    eager = tf.executing_eagerly()
+    if eager:
+        tf.config.threading.set_intra_op_parallelism_threads(config.intra_op_parallelism_threads)
+        tf.config.threading.set_inter_op_parallelism_threads(config.inter_op_parallelism_threads)
+        tf.config.optimizer.set_jit(True)
+        for gpu in tf.config.list_physical_devices('GPU'):
+            tf.config.experimental.set_memory_growth(gpu, True)
+
+    if os.path.exists(args.superresolve_model_path):
+        print(f"Loading model from {args.superresolve_model_path}")
+        superresolve_file = tf.io.gfile.GFile(args.superresolve_model_path + "superresolve_graph.pb", 'rb')
+        superresolve_graph_def.ParseFromString(superresolve_file.read())
+        if args.trt_precision is not None:
+            superresolve_graph_def = convert_to_trt(superresolve_graph_def, ["Add_2"])
+        if eager:
+            superresolve_fn = wrap_superresolve_graph(superresolve_graph_def)
+            superresolve_sess = superresolve_fn
+        else:
+            # Reflect-pad the input and crop the output inside the graph, by mapping
+            # the frozen placeholders onto a padded, unpadded-input placeholder.
+            # Placeholders need an explicit graph, as they raise in eager mode
+            with tf.Graph().as_default() as superresolve_graph:
+                superresolve_inp = tf.compat.v1.placeholder(tf.float32, [None, None, None, 10],
+                                                            name = 'superresolve_input')
+                superresolve_padded = tf.pad(superresolve_inp, [[0, 0], [4, 4], [4, 4], [0, 0]],
+                                             mode = 'REFLECT')
+                tf.import_graph_def(superresolve_graph_def,
+                    input_map = {'Placeholder:0': superresolve_padded,
+                                 'Placeholder_1:0': superresolve_padded[..., 4:]},
+                    name='superresolve')
+                superresolve_logits = superresolve_graph.get_tensor_by_name("superresolve/Add_2:0")
+                superresolve_logits = superresolve_logits[:, 4:-4, 4:-4, :]
+            superresolve_sess = tf.compat.v1.Session(graph=superresolve_graph, config=config)
+            # Compile the feed / fetch signature once, rather than per sess.run(feed_dict)
+            superresolve_fn = superresolve_sess.make_callable(superresolve_logits,
+                                                              [superresolve_inp])
+    else:
+        raise Exception(f"The model path {args.superresolve_model_path} does not exist")
+
+    if os.path.exists(args.predict_model_path):
+        print(f"Loading model from {args.predict_model_path}")
+        predict_file = tf.io.gfile.GFile(args.predict_model_path + "predict_graph.pb", 'rb')
+        predict_graph_def.ParseFromString(predict_file.read())
+        if args.trt_precision is not None:
+            predict_graph_def = convert_to_trt(predict_graph_def, ["conv2d_13/Sigmoid"])
+        if eager:
+            predict_fn = wrap_predict_graph(predict_graph_def)
+            predict_sess = predict_fn
+        else:
+            with tf.Graph().as_default() as predict_graph:
+                if args.fp16_input:
+                    # Feed the input as float16, and cast it back to float32 in the graph
+                    predict_inp = tf.compat.v1.placeholder(tf.float16, [None, None, None, None, 17],
+                                                           name = 'predict_input')
+                    tf.import_graph_def(predict_graph_def,
+                        input_map = {'Placeholder:0': tf.cast(predict_inp, tf.float32)},
+                        name='predict')
+                else:
+                    tf.import_graph_def(predict_graph_def, name='predict')
+            predict_sess = tf.compat.v1.Session(graph=predict_graph, config=config)
+            predict_logits = predict_sess.graph.get_tensor_by_name(f"predict/conv2d_13/Sigmoid:0")
+            if not args.fp16_input:
+                predict_inp = predict_sess.graph.get_tensor_by_name("predict/Placeholder:0")
+            predict_length = predict_sess.graph.get_tensor_by_name("predict/PlaceholderWithDefault:0")
+            predict_fn = predict_sess.make_callable(predict_logits, [predict_inp, predict_length])
+    else:
+        raise Exception(f"The model path {args.predict_model_path} does not exist")
+
+
+def init_worker() -> None:
+    """ Pool initializer, which gives each worker process its own S3 client
+        and tf.Sessions rather than sharing the parent's across a fork
+    """
+    global uploader
+    uploader = FileUploader(awskey = AWSKEY, awssecret = AWSSECRET, overwrite = True)
+    load_models()
+
+
+BBX_COLUMNS = ['min_x', 'min_y', 'max_x', 'max_y']
+
+
+def make_bboxes(xy: np.ndarray, expansion: int = 10) -> np.ndarray:
+    """Vectorized make_bbox, for the (N, 2) X, Y centers of every tile
+
+       Parameters:
+            xy (np.ndarray): (N, 2) array of tile X, Y
+            expansion (int): 1/2 number of 300m pixels to expand
+
+       Returns:
+            bbx (np.ndarray): (N, 4) expanded [min_x, min_y, max_x, max_y]
+    """
+    offset = expansion * (1/360) # Sentinel-2 pixel size in decimal degrees
+    return np.hstack([xy - offset, xy + offset])
+
+
+def smooth_tile_border(row, data) -> None:
+    """ Resegments the border between a tile and its right neighbor, and
+        writes and uploads the smoothed predictions for both tiles
+
+        Parameters:
+         row (pd.Series): row of the processing database for the tile
+         data (pd.DataFrame): processing database, to look up the neighbor
+
+        Returns:
+         None
+    """
+    # The tile ids are formatted once, and reused for every path and key
+    x_i, y_i = int(row['X_tile']), int(row['Y_tile'])
+    x, y, x_right = str(x_i), str(y_i), str(x_i + 1)
+
+    path_to_tile = f'{args.local_path}{x}/{y}/'
+    path_to_right = f'{args.local_path}{x_right}/{y}/'
+
+    print(path_to_tile, path_to_right)
+
+    bbx = list(row[BBX_COLUMNS])
+
+    print(row['X_tile'], row['Y_tile'])
+    neighb_bbx = None
+    #if (x_i + 1) in data['X_tile'] and y_i in data['Y_tile']:
+    print(x_i + 1, y_i)
+    try:
+        data_neighb = data[(data['X_tile'] == x_i + 1) & (data['Y_tile'] == y_i)]
+        data_neighb = data_neighb.reset_index()
+        print(data_neighb['X_tile'][0], data_neighb['Y_tile'][0])
+        neighb_bbx = list(data_neighb.loc[0, BBX_COLUMNS])
+        print(neighb_bbx)
+    except Exception as e:
+        print(f"Ran into {str(e)}")
+    try:
+        finished, s2_shape, s2_neighb_shape, diff = resegment_border(x, y, "right", args.local_path)
+
+    except Exception as e:
+        print(f"Ran into {str(e)}")
+        finished = 0
+        s2_shape = (0, 0)
+        s2_neighb_shape = (0, 0)
+
+    if finished == 1:
+        # The right tile is mosaicked, and the left tile uploaded, in a second thread
+        # so that their file reads and network writes overlap with the main thread
+        pool = ThreadPoolExecutor(max_workers = 2)
+        try:
+            future_right = pool.submit(recreate_resegmented_tifs, path_to_right + "processed/", s2_neighb_shape)
+            predictions_left, _ = recreate_resegmented_tifs(path_to_tile + "processed/", s2_shape)
+            predictions_right, _ = future_right.result()
+            right = predictions_right[:2]
+            left = predictions_left[-2:]
+            right_mean = np.nanmean(right[right < 255]) # these dims are swapped because
+            left_mean = np.nanmean(left[left < 255])  # it gets transposed before writing to disk
+            smooth_diff = abs(right_mean - left_mean)
+            diff = 100 if np.isnan(diff) else diff
+            print(f"Before smooth: {diff}, after smooth: {smooth_diff}")
+            if smooth_diff < (diff + 2):
+
+                # The tifs are streamed to S3 from memory rather than read back from disk
+                memfile_left = write_tif_to_memory(predictions_left, bbx)
+                key = f'2020/tiles/{x}/{y}/{x}X{y}Y_SMOOTH.tif'
+                future_left = pool.submit(uploader.upload_fileobj, bucket = args.s3_bucket,
+                                          key = key, fileobj = memfile_left)
+
+                # The right tile's _SMOOTH.tif is still saved locally, because
+                # load_tif reads it when resegmenting the next border
+                memfile_right = write_tif_to_memory(predictions_right, neighb_bbx)
+                with open(f'{path_to_right}{x_right}X{y}Y_SMOOTH.tif', 'wb') as f:
+                    f.write(memfile_right.read())
+                key = f'2020/tiles/{x_right}/{y}/{x_right}X{y}Y_SMOOTH.tif'
+                uploader.upload_fileobj(bucket = args.s3_bucket, key = key, fileobj = memfile_right)
+
+                # Both uploads have to finish before cleanup deletes the tile's files
+                future_left.result()
+                memfile_left.close()
+                memfile_right.close()
+
+                cleanup(path_to_tile, path_to_right, x, y, delete = True, upload = True)
+                # Mark the border as done only once everything has been uploaded
+                uploader.s3client.put_object(Bucket = args.s3_bucket, Key = border_marker_key(x, y),
+                                             Body = b'', ACL = 'bucket-owner-full-control')
+            else:
+                return None
+                cleanup(path_to_tile, path_to_right, x, y, delete = True, upload = False)
+
+        except Exception as e:
+            print(f"Ran into {str(e)}")
+        finally:
+            pool.shutdown(wait = True)
+
+
+def prefetch_tile_tifs(row, current_row) -> None:
+    """ Downloads the tile and neighbor tifs for row of the processing database,
+        skipping any tile whose folder the border of current_row is using
+    """
+    in_use = [(int(current_row['X_tile']) + i, int(current_row['Y_tile'])) for i in range(2)]
+    to_download = []
+    for i in range(2):
+        tile_idx = (int(row['X_tile']) + i, int(row['Y_tile']))
+        if tile_idx not in in_use:
+            to_download.append(((str(tile_idx[0]), str(tile_idx[1])), "tiles"))
+    download_raw_tiles(to_download, args.local_path)
+
+
+def border_marker_key(x: str, y: str) -> str:
+    """ S3 key of the empty marker that smooth_tile_border uploads after the
+        border between tile x, y and its right neighbor is finished. Neither
+        _SMOOTH.tif can be used for this, as each is also written by the
+        border on the other side of that tile
+    """
+    return f'2020/tiles/{x}/{y}/{x}X{y}Y_border.done'
+
+
+def is_smoothed(row) -> bool:
+    """ Checks if the border of row of the processing database was already
+        smoothed, from the marker that only that border uploads
+    """
+    x = str(int(row['X_tile']))
+    y = str(int(row['Y_tile']))
+    try:
+        uploader.s3client.head_object(Bucket = args.s3_bucket, Key = border_marker_key(x, y))
+        return True
+    except ClientError:
+        return False
+
+
+def smooth_tile_borders(rows) -> None:
+    """ Smooths the tile borders for rows of the processing database in order.
+        Each border writes into the right neighbor's folder, so tiles in the
+        same Y row need to be processed left to right. The next row's tifs
+        are downloaded in the background while the current border is processed
+    """
+    rows = [row for _, row in rows.iterrows()]
+
+    # Skip the borders that are already on S3, e.g. when restarting a run,
+    # probing every row at once to hide the head_object latency
+    if not args.redo_smoothed:
+        with ThreadPoolExecutor(max_workers = 16) as executor:
+            smoothed = list(executor.map(is_smoothed, rows))
+        print(f"Skipping {sum(smoothed)} of {len(rows)} tiles that are already smoothed")
+        rows = [row for row, done in zip(rows, smoothed) if not done]
+
+    prefetch = None
+    with ThreadPoolExecutor(max_workers = 1) as executor:
+        for i, row in enumerate(rows):
+            # The prefetch of this row's tifs has to finish before they are used
+            if prefetch is not None:
+                try:
+                    prefetch.result()
+                except Exception as e:
+                    print(f"Ran into {str(e)}")
+            if i + 1 < len(rows):
+                prefetch = executor.submit(prefetch_tile_tifs, rows[i + 1], row)
+            try:
+                smooth_tile_border(row, data)
+            except KeyboardInterrupt:
+                break
 
-    return None
 
 if __name__ == "__main__":
     SIZE = 412
@@ -940,8 +1473,20 @@ if __name__ == "__main__":
     parser.add_argument("--s3_bucket", dest = "s3_bucket", default = "tof-output")
     parser.add_argument("--yaml_path", dest = "yaml_path", default = "../config.yaml")
     parser.add_argument("--start_id", dest = "start_id", default = 0)
+    parser.add_argument("--n_processes", dest = "n_processes", default = 1)
+    parser.add_argument("--onnx_model_path", dest = "onnx_model_path", default = None)
+    parser.add_argument("--trt_precision", dest = "trt_precision", default = None)
+    parser.add_argument("--redo_smoothed", dest = "redo_smoothed", action = "store_true")
+    parser.add_argument("--fp16_input", dest = "fp16_input", action = "store_true")
     args = parser.parse_args()
 
+    # TF only looks for GPUs once the models are loaded, so they can still be re-enabled
+    if args.trt_precision is not None:
+        if USER_CUDA_VISIBLE_DEVICES is None:
+            del os.environ["CUDA_VISIBLE_DEVICES"]
+        else:
+            os.environ["CUDA_VISIBLE_DEVICES"] = USER_CUDA_VISIBLE_DEVICES
+
     if os.path.exists(args.yaml_path):
         with open(args.yaml_path, 'r') as stream:
             key = (yaml.safe_load(stream))
@@ -953,33 +1498,7 @@ if __name__ == "__main__":
     else:
         raise Exception(f"The API keys do not exist in {args.yaml_path}")
 
-    superresolve_graph_def = tf.compat.v1.GraphDef()
-    predict_graph_def = tf.compat.v1.GraphDef()
     gap_graph_def = tf.compat.v1.GraphDef()
-
-    if os.path.exists(args.superresolve_model_path):
-        print(f"Loading model from {args.superresolve_model_path}")
-        superresolve_file = tf.io.gfile.GFile(args.superresolve_model_path + "superresolve_graph.pb", 'rb')
-        superresolve_graph_def.ParseFromString(superresolve_file.read())
-        superresolve_graph = tf.import_graph_def(superresolve_graph_def, name='superresolve')
-        superresolve_sess = tf.compat.v1.Session(graph=superresolve_graph)
-        superresolve_logits = superresolve_sess.graph.get_tensor_by_name("superresolve/Add_2:0")
-        superresolve_inp = superresolve_sess.graph.get_tensor_by_name("superresolve/Placeholder:0")
-        superresolve_inp_bilinear = superresolve_sess.graph.get_tensor_by_name("superresolve/Placeholder_1:0")
-    else:
-        raise Exception(f"The model path {args.superresolve_model_path} does not exist")
-
-    if os.path.exists(args.predict_model_path):
-        print(f"Loading model from {args.predict_model_path}")
-        predict_file = tf.io.gfile.GFile(args.predict_model_path + "predict_graph.pb", 'rb')
-        predict_graph_def.ParseFromString(predict_file.read())
-        predict_graph = tf.import_graph_def(predict_graph_def, name='predict')
-        predict_sess = tf.compat.v1.Session(graph=predict_graph)
-        predict_logits = predict_sess.graph.get_tensor_by_name(f"predict/conv2d_13/Sigmoid:0")
-        predict_inp = predict_sess.graph.get_tensor_by_name("predict/Placeholder:0")
-        predict_length = predict_sess.graph.get_tensor_by_name("predict/PlaceholderWithDefault:0")
-    else:
-        raise Exception(f"The model path {args.predict_model_path} does not exist")
     """
     if os.path.exists(args.gap_model_path):
         print(f"Loading gap model from {args.gap_model_path}")
@@ -1007,102 +1526,50 @@ if __name__ == "__main__":
                0.509269855802243, 0.948334642387533, 0.6729257769285485, 0.8177635298774327, 0.35768999002433816,
                0.7545951919107605, 0.7602693339366691]
 
-    min_all = np.array(min_all)
-    max_all = np.array(max_all)
-    min_all = np.broadcast_to(min_all, (13, SIZE + 14, SIZE + 14, 17)).astype(np.float32)
-    max_all = np.broadcast_to(max_all, (13, SIZE + 14, SIZE + 14, 17)).astype(np.float32)
+    # These are kept as (17,) vectors, and broadcast along the band axis of the input
+    min_all = np.array(min_all, dtype = np.float32)
+    max_all = np.array(max_all, dtype = np.float32)
     midrange = (max_all + min_all) / 2
     midrange = midrange.astype(np.float32)
     rng = max_all - min_all
     rng = rng.astype(np.float32)
+    # Normalize with a float32 multiply rather than dividing by (rng / 2)
+    inv_half_rng = (2. / rng).astype(np.float32)
 
     if os.path.exists(args.db_path):
-        data = pd.read_csv(args.db_path)
+        # Only the columns that are used are parsed
+        data = pd.read_csv(args.db_path, usecols = ['country', 'X_tile', 'Y_tile', 'X', 'Y'])
         data = data[data['country'] == args.country]
         data = data.reset_index(drop = True)
         print(f"There are {len(data)} tiles for {args.country}")
     else:
         raise Exception(f"The database does not exist at {args.db_path}")
 
-    data['X_tile'] = data['X_tile'].astype(int)
-    data['Y_tile'] = data['Y_tile'].astype(int)
+    # The tile ids are cast after the country filter, as other countries'
+    # rows may have missing or float-formatted ids
+    data['X_tile'] = data['X_tile'].astype(np.int32)
+    data['Y_tile'] = data['Y_tile'].astype(np.int32)
+    # The index is kept as the pre-sort order, which --start_id refers to
     data = data.sort_values(['Y_tile', 'X_tile'], ascending=[False, True])
     print(len(data))
 
-    for index, row in data.iterrows(): # We want to sort this by the X so that it goes from left to right
-        if index >= int(args.start_id):
-            x = str(int(row['X_tile']))
-            y = str(int(row['Y_tile']))
-            x = x[:-2] if ".0" in x else x
-            y = y[:-2] if ".0" in y else y
-
-
-            path_to_tile = f'{args.local_path}{str(x)}/{str(y)}/'
-            path_to_right = f'{args.local_path}{str(int(x) + 1)}/{str(y)}/'
-
-            print(path_to_tile, path_to_right)
-
-            initial_bbx = [row['X'], row['Y'], row['X'], row['Y']]
-            bbx = make_bbox(initial_bbx, expansion = 300/30)
-
-            print(data['X_tile'][index], data['Y_tile'][index])
-            data_neighb = data.copy()
-            neighb_bbx = None
-            #if (int(x) + 1) in data['X_tile'] and int(y) in data['Y_tile']:
-            print(int(x) + 1, int(y))
-            try:
-                data_neighb = data_neighb[data_neighb['X_tile'] == int(x) + 1]
-                data_neighb = data_neighb[data_neighb['Y_tile'] == int(y)]
-                data_neighb = data_neighb.reset_index()
-                neighb = [data_neighb['X'][0], data_neighb['Y'][0], data_neighb['X'][0], data_neighb['Y'][0]]
-                print(data_neighb['X_tile'][0], data_neighb['Y_tile'][0])
-                neighb_bbx = make_bbox(neighb, expansion = 300/30)
-                print(neighb_bbx)
-            except KeyboardInterrupt:
-                break
-            except Exception as e:
-                print(f"Ran into {str(e)}")
-            try:
-                finished, s2_shape, s2_neighb_shape, diff = resegment_border(x, y, "right", args.local_path)
-            except KeyboardInterrupt:
-                break
-
-            except Exception as e:
-                print(f"Ran into {str(e)}")
-                finished = 0
-                s2_shape = (0, 0)
-                s2_neighb_shape = (0, 0)
-
-            if finished == 1:
-                try:
-                    predictions_left, _ = recreate_resegmented_tifs(path_to_tile + "processed/", s2_shape)
-                    predictions_right, _ = recreate_resegmented_tifs(path_to_right + "processed/", s2_neighb_shape)
-                    right = predictions_right[:2]
-                    left = predictions_left[-2:]
-                    right_mean = np.nanmean(right[right < 255]) # these dims are swapped because
-                    left_mean = np.nanmean(left[left < 255])  # it gets transposed before writing to disk
-                    smooth_diff = abs(right_mean - left_mean)
-                    diff = 100 if np.isnan(diff) else diff
-                    print(f"Before smooth: {diff}, after smooth: {smooth_diff}")
-                    if smooth_diff < (diff + 2):
-
-                        file = write_tif(predictions_left, bbx, x, y, path_to_tile, "_SMOOTH")
-                        key = f'2020/tiles/{x}/{y}/{str(x)}X{str(y)}Y_SMOOTH.tif'
-                        uploader.upload(bucket = args.s3_bucket, key = key, file = file)
-
-                        file = write_tif(predictions_right, neighb_bbx, str(int(x) + 1), y, path_to_right, "_SMOOTH")
-                        key = f'2020/tiles/{str(int(x) + 1)}/{y}/{str(int(x) + 1)}X{str(y)}Y_SMOOTH.tif'
-                        uploader.upload(bucket = args.s3_bucket, key = key, file = file)
-
-                        cleanup(path_to_tile, path_to_right, delete = True, upload = True)
-                    else:
-                        continue
-                        cleanup(path_to_tile, path_to_right, delete = True, upload = False)
-
-                except KeyboardInterrupt:
-                    break
-                except Exception as e:
-                    print(f"Ran into {str(e)}")
+    # The bounding boxes of every tile are computed once, rather than per row
+    bbxs = make_bboxes(data[['X', 'Y']].to_numpy(), expansion = 300/30)
+    for i, column in enumerate(BBX_COLUMNS):
+        data[column] = bbxs[:, i]
+
+    # We want to sort this by the X so that it goes from left to right. Different
+    # Y rows don't share any tile folders, so they can be run in parallel
+    rows = data[data.index >= int(args.start_id)]
+    if int(args.n_processes) > 1:
+        # Workers are forked so that they inherit the script's globals
+        groups = [group for _, group in rows.groupby('Y_tile', sort = False)]
+        with multiprocessing.get_context('fork').Pool(int(args.n_processes),
+                                                      initializer = init_worker) as pool:
+            pool.map(smooth_tile_borders, groups)
+    else:
+        load_models()
+        smooth_tile_borders(rows)
 
     """
 
@@ -13,9 +13,11 @@ import pycountry
 import pycountry_convert as pc
 import rasterio
 from rasterio.transform import from_origin
+from rasterio.io import MemoryFile
 import numpy as np
 from glob import glob
 import zipfile
+from concurrent.futures import ThreadPoolExecutor
 
 
 class FileUploader:
@@ -33,6 +35,11 @@ class FileUploader:
             aws_access_key_id=self.awskey,
             aws_secret_access_key=self.awssecret,
         )
+        # Files over 8MB are uploaded as concurrent 8MB multipart chunks
+        self.transfer_config = TransferConfig(multipart_threshold=8 * (1024**2),
+                                              multipart_chunksize=8 * (1024**2),
+                                              max_concurrency=10,
+                                              use_threads=True)
         self.stream = stream
         self.overwrite = overwrite
 
@@ -45,8 +52,15 @@ class FileUploader:
             print("{} %".format(int(self.uploaded / self.total * 100)))
             self.percent = percent
 
-    def upload(self, bucket, key, file):
-        self.total = os.stat(file).st_size
+    def upload(self, bucket, key, file, progress=True):
+        # The progress counters are shared, so uploads that run concurrently
+        # from a thread pool need to pass progress=False
+        callback = None
+        if progress:
+            self.total = os.stat(file).st_size
+            self.uploaded = 0
+            self.percent = 0
+            callback = self.upload_callback
 
         # check if the file exists
         if self.overwrite:
@@ -55,10 +69,8 @@ class FileUploader:
                 file,
                 bucket,
                 key,
-                Config=TransferConfig(5 * (1024**3),
-                                      use_threads=True,
-                                      max_concurrency=20),
-                Callback=self.upload_callback,
+                Config=self.transfer_config,
+                Callback=callback,
                 ExtraArgs={'ACL': 'bucket-owner-full-control'})
         else:
             try:
@@ -76,13 +88,11 @@ class FileUploader:
                 if self.stream:
                     with open(file, 'rb') as data:
                         self.s3client.upload_fileobj(
-                            file,
+                            data,
                             bucket,
                             key,
-                            Config=TransferConfig(5 * (1024**3),
-                                                  use_threads=True,
-                                                  max_concurrency=20),
-                            Callback=self.upload_callback,
+                            Config=self.transfer_config,
+                            Callback=callback,
                             ExtraArgs={'ACL': 'bucket-owner-full-control'})
 
                 else:
@@ -90,14 +100,25 @@ class FileUploader:
                         file,
                         bucket,
                         key,
-                        Config=TransferConfig(5 * (1024**3),
-                                              use_threads=True,
-                                              max_concurrency=20),
-                        Callback=self.upload_callback,
+                        Config=self.transfer_config,
+                        Callback=callback,
                         ExtraArgs={'ACL': 'bucket-owner-full-control'})
                 #print(f'removing {file}')
                 #os.remove(file)
 
+    def upload_fileobj(self, bucket, key, fileobj):
+        """Uploads an in-memory file-like object, e.g. from write_tif_to_memory,
+        so that it does not need to be written to and read back from disk
+        """
+        print(f'uploading {key} to {bucket}')
+        fileobj.seek(0)
+        self.s3client.upload_fileobj(
+            fileobj,
+            bucket,
+            key,
+            Config=self.transfer_config,
+            ExtraArgs={'ACL': 'bucket-owner-full-control'})
+
 
 def get_folder_prefix(coordinates, params):
     geolocation = rg.search((coordinates[0], coordinates[1]))
@@ -232,7 +253,36 @@ def write_tif(arr: np.ndarray,
     #! TODO: Documentation
 
     file = out_folder + f"{str(x)}X{str(y)}Y{suffix}.tif"
+    arr, profile = _tif_profile(arr, point)
+
+    print("Writing", file)
+    new_dataset = rasterio.open(file, 'w', **profile)
+    new_dataset.write(arr, 1)
+    new_dataset.close()
+    return file
+
+
+def write_tif_to_memory(arr: np.ndarray, point: list) -> MemoryFile:
+    """Writes the same GeoTIFF as write_tif, but to an in-memory file that
+    can be passed to FileUploader.upload_fileobj
+
+        Parameters:
+         arr (np.ndarray): (X, Y) predictions
+         point (list): [west, south, east, north] bounds
+
+        Returns:
+         memfile (rasterio.io.MemoryFile)
+    """
+    arr, profile = _tif_profile(arr, point)
+    memfile = MemoryFile()
+    with memfile.open(**profile) as new_dataset:
+        new_dataset.write(arr, 1)
+    memfile.seek(0)
+    return memfile
+
 
+def _tif_profile(arr: np.ndarray, point: list):
+    """Transposes arr to uint8 (Y, X) and makes its GeoTIFF profile"""
     west, east = point[0], point[2]
     north, south = point[3], point[1]
     arr = arr.T.astype(np.uint8)
@@ -243,41 +293,57 @@ def write_tif(arr: np.ndarray,
                                                north=north,
                                                width=arr.shape[1],
                                                height=arr.shape[0])
-
-    print("Writing", file)
-    new_dataset = rasterio.open(file,
-                                'w',
-                                driver='GTiff',
-                                height=arr.shape[0],
-                                width=arr.shape[1],
-                                count=1,
-                                dtype="uint8",
-                                compress='lzw',
-                                crs='+proj=longlat +datum=WGS84 +no_defs',
-                                transform=transform)
-    new_dataset.write(arr, 1)
-    new_dataset.close()
-    return file
-
-
-def download_folder(s3_folder, local_dir, apikey, apisecret, bucket):
+    profile = dict(driver='GTiff',
+                   height=arr.shape[0],
+                   width=arr.shape[1],
+                   count=1,
+                   dtype="uint8",
+                   compress='lzw',
+                   crs='+proj=longlat +datum=WGS84 +no_defs',
+                   transform=transform)
+    return arr, profile
+
+
+def download_folder(s3_folder, local_dir, apikey, apisecret, bucket, max_workers=10):
     """
     Checks to see if a file/key pair exists locally or on s3 or neither, and downloads the folder
+    The keys are listed first, and then downloaded concurrently with max_workers threads.
+    Objects larger than 8MB are additionally fetched as parallel byte ranges
     """
 
     s3 = boto3.resource('s3',
                         aws_access_key_id=apikey,
                         aws_secret_access_key=apisecret)
-    bucket = s3.Bucket(bucket)
-
-    for obj in bucket.objects.filter(Prefix=s3_folder):
+    s3_bucket = s3.Bucket(bucket)
+    transfer_config = TransferConfig(multipart_threshold=8 * (1024**2),
+                                     multipart_chunksize=8 * (1024**2),
+                                     max_concurrency=10,
+                                     use_threads=True)
+    # boto3 clients are thread safe, resources are not. Each of the max_workers
+    # downloads can have max_concurrency range requests in flight on the client
+    s3client = boto3.client(
+        's3',
+        config=botocore.config.Config(
+            max_pool_connections=max_workers * transfer_config.max_concurrency),
+        aws_access_key_id=apikey,
+        aws_secret_access_key=apisecret,
+    )
+
+    to_download = []
+    for obj in s3_bucket.objects.filter(Prefix=s3_folder):
         target = obj.key if local_dir is None \
             else os.path.join(local_dir, os.path.relpath(obj.key, s3_folder))
         if not os.path.exists(os.path.dirname(target)):
             os.makedirs(os.path.dirname(target))
         if obj.key[-1] == '/':
             continue
-        bucket.download_file(obj.key, target)
+        to_download.append((obj.key, target))
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(
+            lambda item: s3client.download_file(bucket, item[0], item[1],
+                                                Config=transfer_config),
+            to_download))
 
 
 def delete_folder(s3_folder, apikey, apisecret, bucket):
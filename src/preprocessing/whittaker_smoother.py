@@ -35,6 +35,15 @@ class Smoother:
         coefmat = E + D
         self.splu_coef = splu(coefmat)
 
+        # The system is only (size x size), so invert it once and smooth every
+        # pixel with a single matrix multiply rather than a sparse solve
+        self.coef_inv = np.linalg.inv(coefmat.toarray().astype(np.float64))
+        if self.average and self.size % 12 == 0:
+            # Fold the monthly mean into the smoothing operator -> (12, size)
+            self.coef_inv = np.reshape(self.coef_inv, (12, self.size // 12, self.size))
+            self.coef_inv = np.mean(self.coef_inv, axis = 1)
+        self.coef_inv = self.coef_inv.astype(np.float32)
+
     def smooth(self, y: np.ndarray) -> np.ndarray:
         '''
         Apply whittaker smoothing to a 1-dimensional array, returning a 1-dimensional array
@@ -43,8 +52,13 @@ class Smoother:
 
     def interpolate_array(self, x) -> np.ndarray:
         x = np.reshape(x, (self.size, self.dimx * self.dimy * self.nbands))
-        x = self.smooth(x)
-        x = np.reshape(x, (self.size, self.dimx, self.dimy, self.nbands))
+        # Cast to the operator's float32, so float64 input isn't smoothed in float64
+        x = np.dot(self.coef_inv, x.astype(self.coef_inv.dtype, copy = False))
+        x = np.reshape(x, (x.shape[0], self.dimx, self.dimy, self.nbands))
+        if self.average and x.shape[0] != 12:
+            # The monthly mean could not be folded into the operator
+            x = np.reshape(x, (12, x.shape[0] // 12, x.shape[1], x.shape[2], x.shape[3]))
+            x = np.mean(x, axis = 1)
 
         # median of zip(range(0, 72, 6), range(6, 72, 6))
         '''
@@ -61,9 +75,4 @@ class Smoother:
                 index += 1
             return monthly
         '''
-        if self.average:
-            x = np.reshape(x, (12, x.shape[0] // 12, x.shape[1], x.shape[2], x.shape[3]))
-            x = np.mean(x, axis = 1)
-            return x
-        else:
-            return x
+        return x
@@ -0,0 +1,39 @@
+import numpy as np
+import unittest
+from src.preprocessing.indices import evi, bi, msavi2, grndvi
+
+
+class TestIndicesOut(unittest.TestCase):
+
+    def setUp(self):
+        # Reflectances in [0, 1], with some out of range values to be clipped
+        rng = np.random.default_rng(0)
+        self.bands = rng.uniform(-0.1, 1.1, size = (13, 16, 16, 13)).astype(np.float32)
+        # make_predict_input writes each index into one channel of the model input
+        self.buffer = np.zeros((13, 16, 16, 17), dtype = np.float32)
+
+    def check_out(self, index_fn, channel):
+        expected = index_fn(np.copy(self.bands))
+        out = self.buffer[..., channel]
+        result = index_fn(self.bands, out = out)
+        self.assertTrue(np.shares_memory(result, self.buffer))
+        self.assertTrue(np.allclose(self.buffer[..., channel], expected, atol = 1e-6))
+        # The other channels of the buffer are left untouched
+        others = np.delete(self.buffer, channel, axis = -1)
+        self.assertTrue(np.all(others == 0))
+
+    def test_evi_out(self):
+        self.check_out(evi, 13)
+
+    def test_bi_out(self):
+        self.check_out(bi, 14)
+
+    def test_msavi2_out(self):
+        self.check_out(msavi2, 15)
+
+    def test_grndvi_out(self):
+        self.check_out(grndvi, 16)
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,38 @@
+import numpy as np
+import unittest
+from src.preprocessing.whittaker_smoother import Smoother
+
+
+class TestSmoother(unittest.TestCase):
+
+    def setUp(self):
+        rng = np.random.default_rng(0)
+        self.data = rng.uniform(0, 1, size = (24, 8, 8, 10)).astype(np.float32)
+
+    def reference(self, sm, x):
+        # Sparse LU solve per pixel, followed by the monthly mean
+        x = np.reshape(x, (sm.size, sm.dimx * sm.dimy * sm.nbands))
+        x = sm.smooth(x)
+        x = np.reshape(x, (12, sm.size // 12, sm.dimx, sm.dimy, sm.nbands))
+        return np.mean(x, axis = 1)
+
+    def test_matches_splu(self):
+        sm = Smoother(lmbd = 100, size = 24, nbands = 10, dimx = 8, dimy = 8)
+        smoothed = sm.interpolate_array(np.copy(self.data))
+        self.assertEqual(smoothed.shape, (12, 8, 8, 10))
+        self.assertTrue(np.allclose(smoothed, self.reference(sm, self.data), atol = 1e-4))
+
+    def test_float64_input(self):
+        sm = Smoother(lmbd = 100, size = 24, nbands = 10, dimx = 8, dimy = 8)
+        smoothed = sm.interpolate_array(self.data.astype(np.float64))
+        self.assertEqual(smoothed.dtype, np.float32)
+
+    def test_no_average(self):
+        sm = Smoother(lmbd = 100, size = 24, nbands = 10, dimx = 8, dimy = 8, average = False)
+        smoothed = sm.interpolate_array(np.copy(self.data))
+        expected = sm.smooth(np.reshape(self.data, (24, -1))).reshape(self.data.shape)
+        self.assertTrue(np.allclose(smoothed, expected, atol = 1e-4))
+
+
+if __name__ == '__main__':
+    unittest.main()